@@ -35,4 +35,5 @@ DEFAULT_HYPERPARAMETERS = {
     "max_content_len": 100,
     "max_seq_len": 128,
     "min_less_portion": 0.5,
+    "num_workers": 0,
 }
\ No newline at end of file
@@ -1,16 +1,16 @@
 import os
 import gc
-import random
 import numpy as np
 import torch
 import time
+from torch.utils.data import DataLoader
 from tqdm import tqdm
 from sklearn.metrics import accuracy_score, precision_recall_fscore_support, confusion_matrix
 import bitsandbytes as bnb
 
 from config import REPORTS_DIR, DEFAULT_BERT_PATH
 from utils.database_manager import DatabaseManager
-from utils.data_loader import LogDataset
+from utils.data_loader import LogDataset, ChunkSampler, collate_log_batch
 from utils.resource_monitor import ResourceMonitor
 from utils.log_visualizer import LogVisualizer
 from logsentinel_model import LogSentinelModel
@@ -22,15 +22,25 @@ class TrainingController:
         self.db = db_manager
         self.callback = callback or (lambda *args: 'CONTINUE')
         self.run_id, self.model, self.train_dataset, self.test_dataset = None, None, None, None
+        self.train_loader = None
         self.visualizer = None
         self.device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
         self.global_step_count, self.total_training_steps, self.run_start_time = 0, 0, 0
         self.batch_losses = [] # For plotting loss curve
+        self._last_cb_t = 0.0
 
     def _log(self, message):
         print(message)
         self.callback({"log": message})
 
+    def _should_report(self, force=False):
+        """Rate-limits progress callbacks to one every 50ms; `force` always reports (e.g. the final step)."""
+        now = time.monotonic()
+        if force or now - self._last_cb_t > 0.05:
+            self._last_cb_t = now
+            return True
+        return False
+
     def _initialize_run(self):
         self.run_id = self.db.create_new_run('Training', self.model_name, self.dataset_name, self.hp)
         if self.run_id:
@@ -42,14 +52,51 @@ class TrainingController:
 
     def _cleanup(self):
         self._log("Cleaning up training resources...")
-        del self.model, self.train_dataset, self.test_dataset, self.visualizer
-        self.model, self.train_dataset, self.test_dataset, self.visualizer = None, None, None, None
+        del self.model, self.train_loader, self.train_dataset, self.test_dataset, self.visualizer
+        self.model, self.train_loader, self.train_dataset, self.test_dataset, self.visualizer = None, None, None, None, None
         gc.collect()
-        if torch.cuda.is_available():
-            torch.cuda.empty_cache()
+        if self.device.type == 'cuda':
+            with torch.cuda.device(self.device):
+                torch.cuda.empty_cache()
         self._log("Cleanup complete.")
 
-    def _train_phase(self, phase_name, n_epochs, lr, indexes_for_phase):
+    def _report_train_status(self, epoch_str, current_loss):
+        elapsed = time.time() - self.run_start_time
+        progress = self.global_step_count / self.total_training_steps if self.total_training_steps > 0 else 0
+        etc = (elapsed / progress) * (1 - progress) if progress > 0 else 0
+        status = {"epoch": epoch_str, "progress": progress, "loss": current_loss, "etc": etc}
+        return self.callback(status)
+
+    def _select_autocast_dtype(self):
+        """bf16 on Ampere+ GPUs (native support, fp32 range, no loss scaling needed), fp16 otherwise."""
+        if self.device.type == 'cuda' and torch.cuda.get_device_capability(self.device)[0] >= 8:
+            return torch.bfloat16
+        return torch.float16
+
+    def _build_train_loader(self, indexes):
+        """Yields shuffled micro-batches; batch assembly is a cheap list lookup, so it runs in-process unless num_workers is set."""
+        num_workers = self.hp.get('num_workers', 0)
+        return DataLoader(
+            self.train_dataset,
+            batch_sampler=ChunkSampler(indexes, self.hp['micro_batch_size']),
+            num_workers=num_workers,
+            collate_fn=collate_log_batch,
+            persistent_workers=num_workers > 0
+        )
+
+    def _precompute_bert_cache(self):
+        """BERT is never trained, so its outputs for the training lines are computed once up front. Returns False if stopped."""
+        self._log("Precomputing BERT embeddings for unique training log lines...")
+        def on_progress(done, total):
+            if self._should_report(force=(done == total)):
+                return self.callback({"epoch": "Caching BERT Embeddings", "progress": done / total})
+        lines = (line for seq in self.train_dataset.sequences for line in seq[:self.hp['max_seq_len']])
+        if not self.model.precompute_bert_cache(lines, on_progress=on_progress):
+            self._log("Stop request received. Aborting training.")
+            return False
+        return True
+
+    def _train_phase(self, phase_name, n_epochs, lr, train_loader):
         if not n_epochs > 0:
             return True
         self._log(f"\n--- Starting Training Phase: {phase_name} ---")
@@ -64,25 +111,26 @@ class TrainingController:
         optimizer = bnb.optim.PagedAdamW8bit(trainable_params, lr=lr)
 
         model_dtype = next(self.model.parameters()).dtype
-        use_scaler = (model_dtype == torch.float16)
+        autocast_dtype = self._select_autocast_dtype()
+        # GradScaler cannot unscale fp16 gradients, which the fp16 projector/classifier heads produce.
+        has_fp16_params = any(p.dtype == torch.float16 for p in trainable_params)
+        use_scaler = (autocast_dtype == torch.float16 and self.device.type == 'cuda' and not has_fp16_params)
         
-        self._log(f"Model DType: {model_dtype}. Using GradScaler: {use_scaler}.")
+        self._log(f"Model DType: {model_dtype}. Autocast DType: {autocast_dtype}. Using GradScaler: {use_scaler}.")
         
         scaler = torch.cuda.amp.GradScaler(enabled=use_scaler)
-        autocast_dtype = model_dtype if model_dtype in [torch.float16, torch.bfloat16] else torch.float16
         grad_accum_steps = self.hp['batch_size'] // self.hp['micro_batch_size']
+        # Losses are summed on-device and only read back once per optimizer step.
+        self._loss_accum = torch.zeros((), device=self.device)
+        current_loss = self.batch_losses[-1] if self.batch_losses else 0.0
 
         for epoch in range(int(n_epochs)):
             epoch_str = f"Epoch {epoch + 1}/{int(n_epochs)} ({phase_name})"
             self._log(f"--- {epoch_str} ---")
-            random.shuffle(indexes_for_phase)
-            optimizer.zero_grad()
-            for i_th, start_idx in enumerate(range(0, len(indexes_for_phase), self.hp['micro_batch_size'])):
+            optimizer.zero_grad(set_to_none=True)
+            self._loss_accum.zero_()
+            for i_th, (seqs, labels) in enumerate(train_loader):
                 self.global_step_count += 1
-                end_idx = min(start_idx + self.hp['micro_batch_size'], len(indexes_for_phase))
-                if not (batch_indexes := indexes_for_phase[start_idx:end_idx]):
-                    continue
-                seqs, labels = self.train_dataset.get_batch(batch_indexes)
 
                 with torch.autocast(device_type=self.device.type, dtype=autocast_dtype, enabled=(self.device.type == 'cuda')):
                     logits, int_labels = self.model.train_helper(seqs, labels)
@@ -90,54 +138,66 @@ class TrainingController:
                         continue
                     loss = criterion(logits, int_labels) / grad_accum_steps
                 
-                scaler.scale(loss).backward()
+                if use_scaler:
+                    scaler.scale(loss).backward()
+                else:
+                    loss.backward()
+                self._loss_accum += loss.detach() * grad_accum_steps
 
                 if (i_th + 1) % grad_accum_steps == 0:
-                    scaler.unscale_(optimizer)
-                    torch.nn.utils.clip_grad_norm_(trainable_params, max_norm=1.0)
-                    scaler.step(optimizer)
-                    scaler.update()
-                    optimizer.zero_grad()
+                    if use_scaler:
+                        scaler.unscale_(optimizer)
+                        torch.nn.utils.clip_grad_norm_(trainable_params, max_norm=1.0)
+                        scaler.step(optimizer)
+                        scaler.update()
+                    else:
+                        torch.nn.utils.clip_grad_norm_(trainable_params, max_norm=1.0)
+                        optimizer.step()
+                    optimizer.zero_grad(set_to_none=True)
+
+                    current_loss = (self._loss_accum / grad_accum_steps).item()
+                    self.batch_losses.append(current_loss)
+                    self._loss_accum.zero_()
                 
-                current_loss = loss.item() * grad_accum_steps
-                self.batch_losses.append(current_loss)
-                elapsed = time.time() - self.run_start_time
-                progress = self.global_step_count / self.total_training_steps if self.total_training_steps > 0 else 0
-                etc = (elapsed / progress) * (1 - progress) if progress > 0 else 0
-                status = {"epoch": epoch_str, "progress": progress, "loss": current_loss, "etc": etc}
-                if self.callback(status) == 'STOP':
+                if self._should_report() and self._report_train_status(epoch_str, current_loss) == 'STOP':
                     self._log("Stop request received. Aborting training.")
                     return False
-        gc.collect()
-        if torch.cuda.is_available():
-            torch.cuda.empty_cache()
+        # Always send the phase's final status, even if its last micro-batch produced no logits.
+        self._should_report(force=True)
+        if self._report_train_status(epoch_str, current_loss) == 'STOP':
+            self._log("Stop request received. Aborting training.")
+            return False
         return True
 
     def _evaluate(self):
         self._log("\n--- Starting Final Evaluation ---")
         self.model.eval()
-        all_preds, gt_labels = [], self.test_dataset.get_all_labels()
+        gt_labels = self.test_dataset.get_all_labels()
         eval_start_time = time.time()
         
-        model_dtype = next(self.model.parameters()).dtype
-        autocast_dtype = model_dtype if model_dtype in [torch.float16, torch.bfloat16] else torch.float16
+        autocast_dtype = self._select_autocast_dtype()
         
         total_items = len(self.test_dataset)
-        with torch.no_grad():
+        # Predictions stay on the device until the loop ends to avoid a sync per batch.
+        pred_buf = torch.empty(total_items, dtype=torch.long, device=self.device)
+        with torch.inference_mode():
             for i in tqdm(range(0, total_items, self.hp['batch_size']), desc="Evaluating"):
+                end_idx = min(i + self.hp['batch_size'], total_items)
                 # --- FIX: Send progress updates during evaluation ---
-                progress = (i + 1) / total_items
-                self.callback({"epoch": "Final Evaluation", "progress": progress})
+                is_last_batch = end_idx == total_items
+                if self._should_report(force=is_last_batch):
+                    progress = end_idx / total_items if is_last_batch else (i + 1) / total_items
+                    self.callback({"epoch": "Final Evaluation", "progress": progress})
 
-                end_idx = min(i + self.hp['batch_size'], total_items)
                 seqs, _ = self.test_dataset.get_batch(list(range(i, end_idx)))
                 with torch.autocast(device_type=self.device.type, dtype=autocast_dtype, enabled=(self.device.type == 'cuda')):
                     logits = self.model(seqs)
-                all_preds.extend(torch.argmax(logits, dim=-1).cpu().numpy())
+                pred_buf[i:end_idx] = torch.argmax(logits, dim=-1)
+        pred_buf_cpu = pred_buf.cpu()
         
         total_eval_time = time.time() - eval_start_time
-        valid_indices = (np.array(all_preds) != -1)
-        preds_numeric, gt_numeric = np.array(all_preds)[valid_indices], gt_labels[valid_indices]
+        valid_mask = pred_buf_cpu.ne(-1)
+        preds_numeric, gt_numeric = pred_buf_cpu[valid_mask].numpy(), gt_labels[valid_mask.numpy()]
         
         p, r, f1, _ = precision_recall_fscore_support(gt_numeric, preds_numeric, average='binary', pos_label=1, zero_division=0)
         p_det, r_det, f1_det, s_det = precision_recall_fscore_support(gt_numeric, preds_numeric, labels=[0, 1], zero_division=0)
@@ -186,6 +246,7 @@ class TrainingController:
             batches_per_epoch = len(base_indexes) // self.hp['micro_batch_size']
             self.total_training_steps = sum([self.hp.get(f'n_epochs_phase{i+1}', 0) * batches_per_epoch for i in range(4)])
             self._log(f"Total training steps calculated: {self.total_training_steps}")
+            self.train_loader = self._build_train_loader(base_indexes)
             
             self.model = LogSentinelModel(DEFAULT_BERT_PATH, self.model_name, None, True, self.device, self.hp['max_content_len'], self.hp['max_seq_len'])
             
@@ -196,13 +257,16 @@ class TrainingController:
                 ("Fine-tuning All", self.model.set_finetuning_all, self.hp['n_epochs_phase4'], self.hp['lr_phase4'])
             ]
             
-            all_phases_completed = True
-            for name, setup_func, epochs, lr in training_phases:
-                setup_func()
-                if not self._train_phase(name, epochs, lr, base_indexes):
-                    all_phases_completed = False
-                    final_status = 'ABORTED'
-                    break
+            all_phases_completed = self._precompute_bert_cache()
+            if not all_phases_completed:
+                final_status = 'ABORTED'
+            else:
+                for name, setup_func, epochs, lr in training_phases:
+                    setup_func()
+                    if not self._train_phase(name, epochs, lr, self.train_loader):
+                        all_phases_completed = False
+                        final_status = 'ABORTED'
+                        break
             
             if all_phases_completed:
                 perf_metrics = self._evaluate()
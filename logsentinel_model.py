@@ -1,5 +1,8 @@
 import torch
 import os
+import functools
+import importlib.util
+import numpy as np
 from torch import nn
 from peft import (
     PeftModel,
@@ -10,22 +13,34 @@ from peft import (
 )
 from transformers import BertTokenizerFast, BertModel
 from utils.model_loader import load_model_and_tokenizer
-from utils.helpers import merge_data, stack_and_pad_left
+from utils.helpers import merge_data, pack_left_padded
 
 class LogSentinelModel(nn.Module):
     def __init__(self, bert_path, llama_path, ft_path=None, is_train_mode=True, device=None, max_content_len=128, max_seq_len=128):
         super().__init__()
+        # TF32 matmuls and cuDNN autotuning speed up any fp32 BERT work on Ampere+ GPUs.
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
+        torch.backends.cudnn.benchmark = True
+        torch.set_float32_matmul_precision('high')
         self.max_content_len = max_content_len
         self.max_seq_len = max_seq_len
         self.device = device or torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 
         self.llama_model, self.llama_tokenizer = load_model_and_tokenizer(llama_path, is_train_mode)
         self.bert_tokenizer = BertTokenizerFast.from_pretrained(bert_path, do_lower_case=True)
+        # Log lines are highly repetitive, so tokenized lines are memoized per raw string.
+        self._tok_one = functools.lru_cache(maxsize=200_000)(self._tokenize_line)
+        self.bert_batch_size = 64 # Process 64 log lines at a time
+        self._token_buffers = None
+        # Pooler outputs for known log lines; valid for the whole run because BERT is never trained (see precompute_bert_cache).
+        self._bert_cache, self._bert_cache_index = None, {}
         self.bert_model = BertModel.from_pretrained(
             bert_path, 
-            low_cpu_mem_usage=True, 
-            gradient_checkpointing=True
+            low_cpu_mem_usage=True
         ).to(self.device)
+        # BERT is a frozen feature extractor in every training phase (see _set_trainable).
+        self.bert_model.requires_grad_(False)
 
         projector_device = self.llama_model.device
         compute_dtype = self.llama_model.dtype
@@ -39,6 +54,11 @@ class LogSentinelModel(nn.Module):
         ).to(projector_device).to(compute_dtype)
 
         self.classifier = nn.Linear(llama_hidden_size, 2).to(projector_device).to(compute_dtype)
+        # Head dtypes are fixed once built; cached so forward passes skip the parameter scans.
+        self._proj_dtype = next(self.projector.parameters()).dtype
+        self._clf_dtype = next(self.classifier.parameters()).dtype
+        self._compile_head(self.projector)
+        self._compile_head(self.classifier)
 
         self.instruc_tokens = self.llama_tokenizer(
             ['Below is a sequence of system log messages:'],
@@ -46,6 +66,32 @@ class LogSentinelModel(nn.Module):
         ).to(projector_device)
         
         self._setup_peft(ft_path, is_train_mode)
+        # Read after PEFT setup: prepare_model_for_kbit_training upcasts the non-quantized LLaMA weights to fp32.
+        self._llama_dtype = self.llama_model.dtype
+
+    def _compile_head(self, module):
+        """Compiles a small head module's forward to cut per-call dispatch and launch overhead."""
+        # Only forward is swapped, so state_dict keys (and the saved projector/classifier files) are unchanged.
+        # The default mode avoids CUDA graphs, which would record a new graph and memory pool for every distinct
+        # row count; dynamic=True compiles a shape-generic kernel for the varying number of log lines per batch.
+        if self.device.type != 'cuda' or importlib.util.find_spec('triton') is None:
+            return
+        eager_forward = module.forward
+        try:
+            compiled_forward = torch.compile(eager_forward, dynamic=True)
+        except Exception as e:
+            print(f"Warning: torch.compile unavailable, running {type(module).__name__} eagerly. Error: {e}")
+            return
+
+        def forward(*args, **kwargs):
+            # Compilation happens lazily on the first call; on failure revert this module to eager for good.
+            try:
+                return compiled_forward(*args, **kwargs)
+            except Exception as e:
+                print(f"Warning: torch.compile failed, running {type(module).__name__} eagerly. Error: {e}")
+                module.forward = eager_forward
+                return eager_forward(*args, **kwargs)
+        module.forward = forward
 
     def _setup_peft(self, ft_path, is_train_mode):
         if ft_path and os.path.exists(os.path.join(ft_path, 'adapter_config.json')):
@@ -88,54 +134,157 @@ class LogSentinelModel(nn.Module):
             elif 'classifier' in name and kwargs.get('classifier'): param.requires_grad = True
             elif 'llama_model' in name and 'lora_' in name and kwargs.get('llama_lora'): param.requires_grad = True
 
+    def train(self, mode=True):
+        super().train(mode)
+        # The frozen BERT is a pure feature extractor, so keep it in eval mode (no dropout) even while training.
+        self.bert_model.eval()
+        return self
+
     def set_train_only_projector(self): self._set_trainable(projector=True)
     def set_train_only_classifier(self): self._set_trainable(classifier=True)
     def set_train_projector_and_classifier(self): self._set_trainable(projector=True, classifier=True)
     def set_finetuning_all(self): self._set_trainable(projector=True, classifier=True, llama_lora=True)
 
-    def get_cls_embeddings(self, sequences_):
-        sequences = [s[:self.max_seq_len] for s in sequences_]
-        merged_logs, start_positions = merge_data(sequences)
-        if not merged_logs: return None, None
+    def _tokenize_line(self, line):
+        encoded = self.bert_tokenizer.encode_plus(line, add_special_tokens=True, truncation=True, max_length=self.max_content_len)
+        return torch.tensor(encoded['input_ids'], dtype=torch.int32)
+
+    def _next_token_buffers(self):
+        """Returns the next of two reusable (ids, mask) host buffers, waiting until its previous H2D copy has finished."""
+        if self._token_buffers is None:
+            pin = self.bert_model.device.type == 'cuda'
+            # Flat buffers so every [n, bucket_len] view taken from them is contiguous and copies straight from pinned memory.
+            numel = self.bert_batch_size * self.max_content_len
+            # Allocated as normal tensors so they can be refilled both inside and outside inference mode.
+            with torch.inference_mode(False):
+                self._token_buffers = [
+                    [torch.empty(numel, dtype=torch.int32, pin_memory=pin), torch.empty(numel, dtype=torch.int32, pin_memory=pin), None]
+                    for _ in range(2)
+                ]
+            self._token_buffer_slot = 0
+        slot = self._token_buffers[self._token_buffer_slot]
+        self._token_buffer_slot ^= 1
+        if slot[2] is not None: slot[2].synchronize()
+        return slot
+
+    def _tokenize_batch(self, batch_logs):
+        """Builds right-padded BERT inputs from the tokenization cache, padded to a power-of-two bucket length."""
+        encoded = [self._tok_one(line) for line in batch_logs]
+        lengths = torch.tensor([ids.shape[0] for ids in encoded])
+        bucket_len = min(self.max_content_len, 1 << (int(lengths.max()) - 1).bit_length())
+
+        slot = self._next_token_buffers()
+        numel = len(encoded) * bucket_len
+        input_ids = slot[0][:numel].view(len(encoded), bucket_len)
+        attention_mask = slot[1][:numel].view(len(encoded), bucket_len)
+        input_ids.fill_(self.bert_tokenizer.pad_token_id)
+        for row, ids in zip(input_ids, encoded): row[:ids.shape[0]].copy_(ids)
+        attention_mask.copy_(torch.arange(bucket_len).unsqueeze(0) < lengths.unsqueeze(1))
+
+        inputs = {
+            'input_ids': input_ids.to(self.bert_model.device, non_blocking=True),
+            'attention_mask': attention_mask.to(self.bert_model.device, non_blocking=True)
+        }
+        if self.bert_model.device.type == 'cuda':
+            slot[2] = torch.cuda.Event()
+            slot[2].record()
+        return inputs
+
+    def _run_bert(self, logs):
+        """Returns BERT pooler outputs for `logs` in their original order, batching lines of similar length together."""
+        if not logs: return None
+        lengths = [self._tok_one(line).shape[0] for line in logs]
+        order = sorted(range(len(logs)), key=lengths.__getitem__)
 
         # --- FIX: Inner-loop batching for BERT processing ---
         all_bert_outputs = []
-        physical_batch_size = 64 # Process 64 log lines at a time
-        with torch.no_grad():
-            for i in range(0, len(merged_logs), physical_batch_size):
-                batch_logs = merged_logs[i:i+physical_batch_size]
-                inputs = self.bert_tokenizer(batch_logs, return_tensors="pt", max_length=self.max_content_len, padding=True, truncation=True).to(self.bert_model.device)
+        # Only Ampere+ runs bf16 natively; is_bf16_supported() also reports emulated support on older GPUs.
+        use_bf16 = self.bert_model.device.type == 'cuda' and torch.cuda.get_device_capability(self.bert_model.device)[0] >= 8
+        with torch.inference_mode(), torch.autocast('cuda', dtype=torch.bfloat16, enabled=use_bf16):
+            for i in range(0, len(order), self.bert_batch_size):
+                batch_logs = [logs[j] for j in order[i:i+self.bert_batch_size]]
+                inputs = self._tokenize_batch(batch_logs)
                 outputs = self.bert_model(**inputs).pooler_output
-                all_bert_outputs.append(outputs.cpu())
-        
-        if not all_bert_outputs: return None, None
-        bert_outputs = torch.cat(all_bert_outputs, dim=0).to(self.device)
+                all_bert_outputs.append(outputs.to(self._proj_dtype))
+            sorted_outputs = torch.cat(all_bert_outputs, dim=0)
         # --- END FIX ---
 
-        projector_dtype = next(self.projector.parameters()).dtype
-        projected_outputs = self.projector(bert_outputs.to(projector_dtype)).to(self.llama_model.dtype)
-        if projected_outputs.shape[0] == 0: return [], self.llama_model.device
-        split_indices = start_positions[1:]
-        if not split_indices: return [projected_outputs], self.llama_model.device
-        return list(torch.tensor_split(projected_outputs, split_indices, dim=0)), self.llama_model.device
+        # Gathering outside inference mode yields a regular tensor the projector can save for backward.
+        inv_order = [0] * len(order)
+        for rank, j in enumerate(order): inv_order[j] = rank
+        return sorted_outputs[torch.as_tensor(inv_order, device=sorted_outputs.device)]
+
+    def precompute_bert_cache(self, all_unique_lines, chunk_size=4096, on_progress=None):
+        """
+        Runs BERT once over every distinct log line so training phases can skip the encoder entirely.
+        `on_progress(done, total)` is called after each chunk; if it returns 'STOP' the cache is left empty and False is returned.
+        """
+        lines = list(dict.fromkeys(all_unique_lines))
+        self._bert_cache, self._bert_cache_index = None, {}
+        chunk_outputs = []
+        for start in range(0, len(lines), chunk_size):
+            chunk_outputs.append(self._run_bert(lines[start:start + chunk_size]))
+            if on_progress and on_progress(min(start + chunk_size, len(lines)), len(lines)) == 'STOP':
+                return False
+        if not chunk_outputs: return True
+        self._bert_cache = torch.cat(chunk_outputs, dim=0)
+        self._bert_cache_index = {line: row for row, line in enumerate(lines)}
+        print(f"Cached BERT embeddings for {len(lines)} unique log lines.")
+        return True
+
+    def _lookup_bert_cache(self, logs):
+        """Returns pooler outputs for `logs` from the cache, running BERT only on lines it has not seen."""
+        rows = [self._bert_cache_index.get(line, -1) for line in logs]
+        device = self._bert_cache.device
+        hit_pos = [i for i, row in enumerate(rows) if row >= 0]
+        if len(hit_pos) == len(logs):
+            return self._bert_cache[torch.as_tensor(rows, device=device)]
+        miss_pos = [i for i, row in enumerate(rows) if row < 0]
+        outputs = self._bert_cache.new_empty((len(logs), self._bert_cache.shape[1]))
+        if hit_pos:
+            outputs[torch.as_tensor(hit_pos, device=device)] = self._bert_cache[torch.as_tensor([rows[i] for i in hit_pos], device=device)]
+        outputs[torch.as_tensor(miss_pos, device=device)] = self._run_bert([logs[i] for i in miss_pos]).to(device)
+        return outputs
+
+    def get_cls_embeddings(self, sequences_):
+        sequences = [s[:self.max_seq_len] for s in sequences_]
+        merged_logs, start_positions = merge_data(sequences)
+        if not merged_logs: return None, None
+
+        # Run BERT once per distinct log line and scatter the results back to every occurrence.
+        unique_index = {}
+        inverse = [unique_index.setdefault(line, len(unique_index)) for line in merged_logs]
+        unique_logs = list(unique_index)
+
+        if self._bert_cache is not None:
+            unique_outputs = self._lookup_bert_cache(unique_logs)
+        else:
+            unique_outputs = self._run_bert(unique_logs)
+        if unique_outputs is None: return None, None
+        bert_outputs = unique_outputs[torch.as_tensor(inverse, device=unique_outputs.device)].to(self.device)
+
+        projected_outputs = self.projector(bert_outputs).to(self._llama_dtype)
+        seq_lens = np.diff(start_positions + [len(merged_logs)])
+        return projected_outputs, seq_lens
 
     def _get_logits(self, sequences_):
-        seq_embeddings, embed_device = self.get_cls_embeddings(sequences_)
-        if seq_embeddings is None: return None, None
+        projected_outputs, seq_lens = self.get_cls_embeddings(sequences_)
+        if projected_outputs is None: return None, None
+        original_indices = np.flatnonzero(seq_lens).tolist()
+        if not original_indices: return None, None
         embed_layer = self.llama_model.get_input_embeddings(); instruc_embeds = embed_layer(self.instruc_tokens['input_ids'])
-        valid_embeddings, original_indices = [], []
-        for i, seq_embed in enumerate(seq_embeddings):
-            if seq_embed is not None and seq_embed.shape[0] > 0:
-                full_embed = torch.cat([instruc_embeds[0], seq_embed], dim=0); valid_embeddings.append(full_embed); original_indices.append(i)
-        if not valid_embeddings: return None, None
-        inputs_embeds, attention_mask = stack_and_pad_left(valid_embeddings)
-        outputs = self.llama_model(inputs_embeds=inputs_embeds, attention_mask=attention_mask, output_hidden_states=True)
+        inputs_embeds, attention_mask = pack_left_padded(instruc_embeds[0], projected_outputs, seq_lens[original_indices])
+        # Run only the decoder stack (LoRA layers are injected in place) so the LM head and per-layer hidden states are never materialized.
+        if hasattr(self.llama_model, 'get_decoder'):
+            outputs = self.llama_model.get_decoder()(inputs_embeds=inputs_embeds, attention_mask=attention_mask, use_cache=False)
+        else:
+            outputs = self.llama_model(inputs_embeds=inputs_embeds, attention_mask=attention_mask, output_hidden_states=True, use_cache=False)
         if hasattr(outputs, 'last_hidden_state'): last_hidden_state = outputs.last_hidden_state
         elif hasattr(outputs, 'hidden_states'): last_hidden_state = outputs.hidden_states[-1]
         else: raise AttributeError("Model output does not contain 'last_hidden_state' or 'hidden_states'.")
-        sequence_lengths = attention_mask.sum(dim=1) - 1; batch_indices = torch.arange(len(valid_embeddings), device=last_hidden_state.device)
+        sequence_lengths = attention_mask.sum(dim=1) - 1; batch_indices = torch.arange(len(original_indices), device=last_hidden_state.device)
         cls_input_hidden_state = last_hidden_state[batch_indices, sequence_lengths]
-        classifier_dtype = next(self.classifier.parameters()).dtype; logits = self.classifier(cls_input_hidden_state.to(classifier_dtype))
+        logits = self.classifier(cls_input_hidden_state.to(self._clf_dtype))
         return logits, original_indices
 
     def forward(self, sequences_):
@@ -152,6 +301,7 @@ class LogSentinelModel(nn.Module):
         self.train()
         logits, original_indices = self._get_logits(sequences_)
         if logits is None: return torch.tensor([]), torch.tensor([])
-        valid_str_labels = [labels[i] for i in original_indices]
-        integer_labels = torch.tensor([1 if lbl == 'anomalous' else 0 for lbl in valid_str_labels], dtype=torch.long, device=logits.device)
+        valid_labels = torch.from_numpy(labels[original_indices])
+        if logits.device.type == 'cuda': valid_labels = valid_labels.pin_memory()
+        integer_labels = valid_labels.to(logits.device, dtype=torch.long, non_blocking=True)
         return logits, integer_labels
\ No newline at end of file
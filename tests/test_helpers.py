@@ -0,0 +1,23 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from utils.helpers import pack_left_padded, stack_and_pad_left
+
+
+def test_pack_left_padded_matches_stack_and_pad_left():
+    torch.manual_seed(0)
+    prefix = torch.randn(3, 4)
+    seq_lens = [2, 0, 5, 1]
+    flat = torch.randn(sum(seq_lens), 4)
+
+    expected_embeds, expected_mask = stack_and_pad_left([torch.cat([prefix, chunk]) for chunk in torch.split(flat, seq_lens)])
+    embeds, mask = pack_left_padded(prefix, flat, seq_lens)
+
+    assert torch.equal(embeds, expected_embeds)
+    assert torch.equal(mask, expected_mask)
+
+
+def test_pack_left_padded_rejects_dtype_mismatch():
+    with pytest.raises(ValueError):
+        pack_left_padded(torch.zeros(2, 4), torch.zeros(3, 4, dtype=torch.float16), [3])
@@ -1,7 +1,8 @@
 import pandas as pd
 import numpy as np
 import re
-from torch.utils.data import Dataset
+import random
+from torch.utils.data import Dataset, Sampler
 
 # --- Preprocessing Patterns ---
 _PATTERNS = [
@@ -31,6 +32,7 @@ class LogDataset(Dataset):
         
         self.sequences = [content.split(' ;-; ') for content in df['Processed_Content'].values]
         self.labels = df['Label'].values
+        self.binary_labels = (self.labels == 1).astype(np.uint8)
 
         self._calculate_class_stats()
         print(f"Dataset initialized. Total sequences: {len(self.labels)}")
@@ -57,15 +59,35 @@ class LogDataset(Dataset):
     def __len__(self):
         return len(self.labels)
 
+    def __getitem__(self, index):
+        return self.sequences[index], self.binary_labels[index]
+
     def get_batch(self, indexes):
         """
-        Returns sequences and string labels for a given list of indices.
+        Returns sequences and 0/1 (normal/anomalous) uint8 labels for a given list of indices.
         """
         this_batch_seqs = [self.sequences[i] for i in indexes]
-        temp_numeric_labels = self.labels[indexes]
-        this_batch_labels = ['anomalous' if lbl == 1 else 'normal' for lbl in temp_numeric_labels]
+        this_batch_labels = self.binary_labels[indexes]
         return this_batch_seqs, this_batch_labels
 
     def get_all_labels(self):
         """Returns all labels as a NumPy array of integers."""
-        return self.labels
\ No newline at end of file
+        return self.labels
+
+class ChunkSampler(Sampler):
+    """Yields consecutive `chunk_size` slices of `indexes`, reshuffled at the start of every epoch."""
+    def __init__(self, indexes, chunk_size):
+        self.indexes = list(indexes)
+        self.chunk_size = chunk_size
+
+    def __iter__(self):
+        random.shuffle(self.indexes)
+        for start in range(0, len(self.indexes), self.chunk_size):
+            yield self.indexes[start:start + self.chunk_size]
+
+    def __len__(self):
+        return (len(self.indexes) + self.chunk_size - 1) // self.chunk_size
+
+def collate_log_batch(items):
+    """Collates (sequence, label) pairs into the (sequences, uint8 labels) layout returned by LogDataset.get_batch."""
+    return [seq for seq, _ in items], np.array([label for _, label in items], dtype=np.uint8)
\ No newline at end of file
@@ -28,6 +28,31 @@ def stack_and_pad_left(tensors):
         padded_tensors.append(padded_tensor)
     return torch.stack(padded_tensors), torch.stack(padding_masks)
 
+def pack_left_padded(prefix, flat, seq_lens):
+    """
+    Builds a left-padded [B, max_len, H] batch of `prefix` followed by each sequence's rows of `flat`,
+    along with its attention mask, without a per-sequence Python loop.
+    """
+    if prefix.dtype != flat.dtype:
+        raise ValueError(f"Prefix dtype {prefix.dtype} does not match sequence embedding dtype {flat.dtype}.")
+    device = flat.device
+    prefix_len, hidden_size = prefix.shape
+    lens = torch.as_tensor(seq_lens, dtype=torch.long, device=device)
+    batch_size, max_len = lens.shape[0], prefix_len + int(max(seq_lens))
+    batch_ids = torch.arange(batch_size, device=device)
+    pad_lens = max_len - prefix_len - lens
+
+    row_seq = torch.repeat_interleave(batch_ids, lens, output_size=flat.shape[0])
+    starts = torch.cumsum(lens, dim=0) - lens
+    row_pos = torch.arange(flat.shape[0], device=device) - starts[row_seq] + pad_lens[row_seq] + prefix_len
+    prefix_pos = pad_lens.unsqueeze(1) + torch.arange(prefix_len, device=device)
+
+    padded = flat.new_zeros(batch_size, max_len, hidden_size)
+    padded[batch_ids.unsqueeze(1), prefix_pos] = prefix.expand(batch_size, -1, -1)
+    padded[row_seq, row_pos] = flat
+    attention_mask = (torch.arange(max_len, device=device).unsqueeze(0) >= pad_lens.unsqueeze(1)).long()
+    return padded, attention_mask
+
 def safe_np_array(data, default_val=-1):
     """Converts a list to a numpy array, replacing None with a default value."""
     return np.array([item if item is not None else default_val for item in data])
\ No newline at end of file